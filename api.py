@@ -8,13 +8,32 @@ http://opensource.org/licenses/mit-license.php
 
 import logging
 import asyncio
+import copy
+import time
 import aiohttp
-import urllib.parse
-from typing import Dict, List, Any, Optional, Callable, TypedDict, Union
+import orjson
+from typing import Dict, List, Any, Optional, Callable, Tuple, TypedDict, Union
 
 # 定数
 ENDPOINT = 'https://unitrad.calil.jp/v1/'
 FIELDS = ['free', 'title', 'author', 'publisher', 'isbn', 'ndc', 'year_start', 'year_end', 'region']
+FIELDS_NO_REGION = tuple(k for k in FIELDS if k != 'region')
+POLL_DELAY_MIN = 0.05
+POLL_DELAY_MAX = 1.0
+RESULT_CACHE_TTL = 60
+MAPPING_CACHE_TTL = 60 * 60
+
+# 共有HTTPセッション（keep-aliveで接続を再利用する）
+#   セッションとロックは作成したイベントループに属するので、ループごとに作り直す
+_SESSION: Optional[aiohttp.ClientSession] = None
+_SESSION_LOCK: Optional[asyncio.Lock] = None
+_SESSION_LOOP: Optional[asyncio.AbstractEventLoop] = None
+
+# 直前に完了した検索（保存時刻, クエリ, 結果）
+_LAST_RESULT: Optional[tuple] = None
+
+# リージョンごとのマッピングデータ（region -> (保存時刻, ETag, データ)）
+_MAPPING_CACHE: Dict[str, tuple] = {}
 
 # 型定義
 class UnitradQuery(TypedDict, total=False):
@@ -47,22 +66,72 @@ class UnitradResult(TypedDict):
 
 # ヘルパー関数
 
-def object_to_query_string(params: Dict[str, Any]) -> str:
+async def _get_session() -> aiohttp.ClientSession:
+    """
+    共有HTTPセッションを取得する
+      実行中のイベントループで初めて呼び出された時に生成し、以降は同じセッションを返す
+    
+    Returns:
+        HTTPセッション
+    """
+    global _SESSION, _SESSION_LOCK, _SESSION_LOOP
+    loop = asyncio.get_running_loop()
+    if _SESSION_LOOP is not loop:
+        # 以前のループのセッションはこのループからは使えない（閉じることもできない）
+        _SESSION = None
+        _SESSION_LOCK = asyncio.Lock()
+        _SESSION_LOOP = loop
+    if _SESSION is None or _SESSION.closed:
+        async with _SESSION_LOCK:
+            if _SESSION is None or _SESSION.closed:
+                connector = aiohttp.TCPConnector(limit=100, limit_per_host=20,
+                                                 keepalive_timeout=60, ttl_dns_cache=300)
+                _SESSION = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=30, connect=5))
+    return _SESSION
+
+
+async def close_session() -> None:
+    """
+    共有HTTPセッションを閉じる
+      イベントループを終了する前に、そのループ上で呼び出す
+    """
+    global _SESSION
+    if _SESSION is not None and _SESSION_LOOP is asyncio.get_running_loop():
+        await _SESSION.close()
+    _SESSION = None
+
+
+async def _send(command: str, params: Dict[str, Any] = None,
+                headers: Dict[str, str] = None) -> Tuple[int, Optional[str], Any]:
     """
-    クエリパラメータをURLに変換するヘルパー関数
+    Unitrad APIにアクセスする
+      条件付きリクエストのため、304はエラーにせずデータなしで返す
     
     Args:
-        params: オブジェクトパラメータ
+        command: APIのコマンド
+        params: クエリパラメータ
+        headers: 追加のリクエストヘッダー
     
     Returns:
-        URLクエリ文字列
-    """
-    query_params = []
-    for key, value in params.items():
-        if value is not None and value != '':
-            query_params.append(f"{urllib.parse.quote(key)}={urllib.parse.quote(str(value))}")
+        ステータスコード, ETag, APIレスポンス（304の場合はNone）
     
-    return f"?{'&'.join(query_params)}" if query_params else ""
+    Raises:
+        Exception: API呼び出しに失敗した場合
+    """
+    # 空の値は送らない（エンコードはaiohttpに任せる）
+    query = {k: str(v) for k, v in (params or {}).items() if v is not None and v != ''}
+    session = await _get_session()
+    async with session.get(f"{ENDPOINT}{command}", params=query, headers=headers) as response:
+        logging.info(response.url)
+        etag = response.headers.get('ETag')
+        if response.status == 304:
+            return response.status, etag, None
+        if response.status != 200:
+            raise Exception(f"API request failed: {response.status}")
+        
+        return response.status, etag, await response.json(loads=orjson.loads)
+
 
 async def _request(command: str, params: Dict[str, Any] = None) -> Any:
     """
@@ -78,22 +147,15 @@ async def _request(command: str, params: Dict[str, Any] = None) -> Any:
     Raises:
         Exception: API呼び出しに失敗した場合
     """
-    if params is None:
-        params = {}
-        
-    url = f"{ENDPOINT}{command}{object_to_query_string(params)}"
-    logging.info(url)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                raise Exception(f"API request failed: {response.status}")
-            
-            return await response.json()
+    _, _, data = await _send(command, params)
+    return data
 
 
 class Api:
     """横断検索APIクラス"""
     
+    __slots__ = ('callback', 'data', '_poll_delay', '_task')
+    
     def __init__(self, query: UnitradQuery, callback: Callable[[UnitradResult], None]):
         """
         検索APIの起動
@@ -103,58 +165,88 @@ class Api:
             callback: コールバック関数
         """
         self.callback = callback
-        self.killed = False
         self.data = None
-        asyncio.create_task(self.search(query))
+        self._poll_delay = POLL_DELAY_MIN
+        self._task = asyncio.create_task(self._run(query))
     
     def kill(self) -> None:
-        """検索の中止"""
-        self.killed = True
+        """検索の中止（実行中のリクエストもその場で打ち切る）"""
+        self._task.cancel()
     
-    async def search(self, query: UnitradQuery) -> None:
+    async def _run(self, query: UnitradQuery) -> None:
         """
-        検索を実行
+        検索からポーリング完了までを1つのタスクで実行
         
         Args:
             query: 検索クエリ
         """
-        logging.info("Starting Unitrad search")
-        logging.info(query)
-        if self.killed:
-            return
+        global _LAST_RESULT
+        if _LAST_RESULT is not None:
+            stored_at, last_query, last_data = _LAST_RESULT
+            if (time.monotonic() - stored_at <= RESULT_CACHE_TTL
+                    and is_equal_query(query, last_query)
+                    and query.get('region', '') == last_query.get('region', '')):
+                logging.info("Unitrad search cache hit")
+                # 利用側が変更してもキャッシュに影響しないよう、インスタンスごとに複製を渡す
+                self.data = copy.deepcopy(last_data)
+                self.callback(self.data)
+                return
         
         try:
-            data = await _request('search', strip_query(query))
+            await self._search_loop(query)
+            if self.data['running']:
+                await self._poll_loop()
+        except asyncio.CancelledError:
+            logging.info('[Unitrad] killed.')
+            return
+        _LAST_RESULT = (time.monotonic(), dict(query), copy.deepcopy(self.data))
+    
+    async def _search_loop(self, query: UnitradQuery) -> None:
+        """
+        検索を実行（失敗時は成功するまで再試行する）
+        
+        Args:
+            query: 検索クエリ
+        """
+        logging.info("Starting Unitrad search")
+        logging.info(query)
+        while True:
+            try:
+                data = await _request('search', strip_query(query))
+            except Exception as err:
+                logging.info(f"Search error: {err}")
+                # エラー時は少し待って再試行
+                await asyncio.sleep(1)
+                continue
             await self.receive(data)
-        except Exception as err:
-            logging.info(f"Search error: {err}")
-            # エラー時は少し待って再試行
-            await asyncio.sleep(1)
-            asyncio.create_task(self.search(query))
+            return
     
-    async def polling(self) -> None:
-        """ポーリングを実行"""
+    async def _poll_loop(self) -> None:
+        """
+        ポーリングを実行
+          サーバー側のロングポーリングに任せ、データが無い場合のみ待機時間を倍々に延ばす
+        """
         logging.info("Starting Unitrad polling")
-        if self.killed:
-            return
-        
-        try:
-            data = await _request('polling', {
-                'uuid': self.data['uuid'],
-                'version': self.data['version'],
-                'diff': 1,
-                'timeout': 10
-            })
+        while True:
+            try:
+                data = await _request('polling', {
+                    'uuid': self.data['uuid'],
+                    'version': self.data['version'],
+                    'diff': 1,
+                    'timeout': 10
+                })
+            except Exception as err:
+                logging.info(f"Polling error: {err}")
+                data = None
             
             if data is None:
-                await asyncio.sleep(1)
-                asyncio.create_task(self.polling())
+                self._poll_delay = min(self._poll_delay * 2, POLL_DELAY_MAX)
             else:
+                self._poll_delay = POLL_DELAY_MIN
                 await self.receive(data)
-        except Exception as err:
-            logging.info(f"Polling error: {err}")
-            await asyncio.sleep(1)
-            asyncio.create_task(self.polling())
+                if not self.data['running']:
+                    return
+            await asyncio.sleep(self._poll_delay)
     
     async def receive(self, data: UnitradResult) -> None:
         """
@@ -164,30 +256,29 @@ class Api:
             data: APIのレスポンスデータ
         """
         logging.info("Received data from Unitrad API")
-        if self.killed:
-            return
-        
-        if 'books_diff' in data and data['books_diff']:
+        books_diff = data.get('books_diff')
+        if books_diff:
             # 差分更新の場合
-            self.data['books'].extend(data['books_diff']['insert'])
+            self.data['books'].extend(books_diff['insert'])
             
             # books_diff以外のプロパティを更新
-            for key, value in data.items():
-                if key != 'books_diff':
-                    self.data[key] = value
+            rest = data.copy()
+            del rest['books_diff']
+            self.data.update(rest)
             
             # 個別の書籍データを更新
-            for d in data['books_diff']['update']:
+            books = self.data['books']
+            for d in books_diff['update']:
+                target = books[d['_idx']]
                 for key, value in d.items():
-                    if key != '_idx':
-                        idx = d['_idx']
-                        if isinstance(value, list):
-                            self.data['books'][idx][key].extend(value)
-                        elif isinstance(value, dict):
-                            for k, v in value.items():
-                                self.data['books'][idx][key][k] = v
-                        else:
-                            self.data['books'][idx][key] = value
+                    if key == '_idx':
+                        continue
+                    if isinstance(value, list):
+                        target[key].extend(value)
+                    elif isinstance(value, dict):
+                        target[key].update(value)
+                    else:
+                        target[key] = value
         else:
             # 完全に新しいデータの場合
             self.data = data
@@ -196,14 +287,8 @@ class Api:
         self.callback(self.data)
         
         # 継続判定
-        if data['running'] is True:
+        if data.get('running') is True:
             logging.info('[Unitrad] continue...')
-            if data['version'] == 1 and len(self.data['books']) == 0:
-                await asyncio.sleep(0.02)
-                asyncio.create_task(self.polling())
-            else:
-                await asyncio.sleep(0.5)
-                asyncio.create_task(self.polling())
         else:
             logging.info('[Unitrad] complete.')
 
@@ -218,10 +303,7 @@ def normalize_query(query: Dict[str, str]) -> UnitradQuery:
     Returns:
         正規化されたクエリ
     """
-    tmp = {}
-    for k in FIELDS:
-        tmp[k] = query.get(k, '')
-    return tmp
+    return {k: query.get(k, '') for k in FIELDS}
 
 
 def is_empty_query(query: Optional[UnitradQuery]) -> bool:
@@ -235,13 +317,7 @@ def is_empty_query(query: Optional[UnitradQuery]) -> bool:
     Returns:
         空かどうか
     """
-    if query:
-        for k in FIELDS:
-            if k == 'region':
-                continue
-            if k in query and query[k] != '':
-                return False
-    return True
+    return not query or all(query.get(k, '') == '' for k in FIELDS_NO_REGION)
 
 
 def is_equal_query(q1: Optional[UnitradQuery], q2: Optional[UnitradQuery]) -> bool:
@@ -255,14 +331,9 @@ def is_equal_query(q1: Optional[UnitradQuery], q2: Optional[UnitradQuery]) -> bo
     Returns:
         同じかどうか
     """
-    for k in FIELDS:
-        if k == 'region':
-            continue
-        val1 = q1.get(k, '') if q1 else ''
-        val2 = q2.get(k, '') if q2 else ''
-        if val1 != val2:
-            return False
-    return True
+    q1 = q1 or {}
+    q2 = q2 or {}
+    return all(q1.get(k, '') == q2.get(k, '') for k in FIELDS_NO_REGION)
 
 
 def strip_query(query: UnitradQuery) -> UnitradQuery:
@@ -275,11 +346,7 @@ def strip_query(query: UnitradQuery) -> UnitradQuery:
     Returns:
         内容のあるプロパティのみのクエリ
     """
-    tmp = {}
-    for k in FIELDS:
-        if k in query and query[k] != '':
-            tmp[k] = query[k]
-    return tmp
+    return {k: query[k] for k in FIELDS if query.get(k, '') != ''}
 
 
 async def fetch_mapping(region: str, callback: Callable[[Any], None]) -> None:
@@ -290,8 +357,19 @@ async def fetch_mapping(region: str, callback: Callable[[Any], None]) -> None:
         region: リージョン
         callback: コールバック関数
     """
+    cached = _MAPPING_CACHE.get(region)
+    if cached is not None and time.monotonic() - cached[0] <= MAPPING_CACHE_TTL:
+        callback(cached[2])
+        return
+    
     try:
-        data = await _request('mapping', {'region': region})
+        # 取得済みであればETagで更新の有無だけ確認する
+        headers = {'If-None-Match': cached[1]} if cached is not None and cached[1] else {}
+        status, etag, data = await _send('mapping', {'region': region}, headers)
+        if status == 304:
+            etag = etag or cached[1]
+            data = cached[2]
+        _MAPPING_CACHE[region] = (time.monotonic(), etag, data)
         callback(data)
     except Exception as err:
         logging.info(f"Mapping fetch error: {err}")
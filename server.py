@@ -1,12 +1,23 @@
+import asyncio
 import logging
-from typing import Optional
-import json
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple, TypedDict
 import httpx
+import ijson
+import orjson
 from mcp.server.fastmcp import FastMCP, Context
-from pydantic import BaseModel
 
+try:
+    # uvloopが使える環境ではイベントループを差し替える（Windowsは非対応）
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
-class BookSummary(BaseModel):
+
+class BookSummary(TypedDict):
     id: str
     isbn: Optional[str]
     title: str
@@ -16,7 +27,182 @@ class BookSummary(BaseModel):
     url: Optional[str]
 
 
-mcp = FastMCP("nlib-mcp-server")
+# 中津川市立図書館のUnitrad上のID（holdingsは数値、urlは文字列キー）
+LIBRARY_ID = 100914
+LIBRARY_KEY = str(LIBRARY_ID)
+# 検索が完了するまで待つ対象（remainsに残っている間はポーリングする）
+TARGET_LIB = "中津川市"
+
+# Unitrad APIへの共有クライアント（HTTP/2で検索とポーリングを1接続に多重化する）
+#   lifespanはセッションごとに呼ばれるため、プロセス全体で使い回し、閉じられていれば作り直す
+_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """共有クライアントを取得する"""
+    global _CLIENT
+    if _CLIENT is None or _CLIENT.is_closed:
+        _CLIENT = httpx.AsyncClient(
+            base_url="https://unitrad-osaka-1.calil.jp/v1/",
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=100),
+            timeout=httpx.Timeout(30.0, connect=5.0),
+        )
+    return _CLIENT
+
+
+@asynccontextmanager
+async def lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """
+    サーバー起動時にタスクを即時実行に切り替える
+      キャッシュヒットなど最初のawaitまでに完了する呼び出しはスケジューラを経由しない
+      lifespanはセッションごとに呼ばれるため、ループ全体の設定は最初の1回だけ行い元に戻さない
+    """
+    loop = asyncio.get_running_loop()
+    if loop.get_task_factory() is None:
+        loop.set_task_factory(asyncio.eager_task_factory)
+    yield
+
+
+mcp = FastMCP("nlib-mcp-server", lifespan=lifespan)
+
+# 検索結果のキャッシュ（正規化したクエリ -> (保存時刻, レスポンス)）
+CACHE_TTL = 60
+CACHE_MAXSIZE = 128
+_CACHE: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+
+# 実行中の検索（同じクエリの同時呼び出しは1回の検索にまとめる）
+_INFLIGHT: dict[tuple, asyncio.Task] = {}
+
+
+def _cache_get(key: tuple) -> Optional[str]:
+    """キャッシュから有効期限内の検索結果を取得する"""
+    entry = _CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, value = entry
+    if time.monotonic() - stored_at > CACHE_TTL:
+        del _CACHE[key]
+        return None
+    _CACHE.move_to_end(key)
+    return value
+
+
+def _cache_put(key: tuple, value: str) -> None:
+    """検索結果をキャッシュに保存する（古いものから追い出す）"""
+    _CACHE[key] = (time.monotonic(), value)
+    _CACHE.move_to_end(key)
+    while len(_CACHE) > CACHE_MAXSIZE:
+        _CACHE.popitem(last=False)
+
+
+def _summarize_book(book: dict) -> BookSummary:
+    """Unitradの書籍データからツールの返却形式を作る"""
+    return {
+        "id": book['id'],
+        "isbn": book.get('isbn') or '',
+        "title": book['title'],
+        "author": book['author'],
+        "publisher": book['publisher'],
+        "published_year": str(pubdate) if (pubdate := book.get('pubdate')) else '',
+        "url": (book.get('url') or {}).get(LIBRARY_KEY) or ''
+    }
+
+
+async def _fetch(command: str, params: dict) -> Optional[Tuple[dict, List[BookSummary]]]:
+    """
+    Unitrad APIのレスポンスを逐次パースする（失敗時はNone）
+      書籍は所蔵分だけを残すので、メモリ使用量は返却する件数分に収まる
+    """
+    async with _get_client().stream("GET", command, params=params) as response:
+        logging.info(response.url)
+        if response.status_code != 200:
+            return None
+
+        data: dict = {}
+        books: List[BookSummary] = []
+        builder: Optional[ijson.ObjectBuilder] = None
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+        async for chunk in response.aiter_bytes():
+            parser.send(chunk)
+            for prefix, event, value in events:
+                if builder is not None:
+                    # 書籍1件分を組み立て、所蔵していれば残す
+                    builder.event(event, value)
+                    if prefix == 'books.item' and event == 'end_map':
+                        book = builder.value
+                        builder = None
+                        if LIBRARY_ID in (book.get('holdings') or ()):
+                            books.append(_summarize_book(book))
+                elif prefix == 'books.item' and event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix == 'remains' and event == 'start_array':
+                    data['remains'] = []
+                elif prefix == 'remains.item':
+                    data['remains'].append(value)
+                elif prefix and '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+                    # uuid, version, runningなどの制御用フィールド
+                    data[prefix] = value
+            del events[:]
+        parser.close()
+        return data, books
+
+
+async def _notify(log: Callable[[str], Awaitable[None]], message: str) -> None:
+    """
+    検索元にログを通知する
+      共有検索では元の呼び出しが先に終わっていることがあるので、通知の失敗は無視する
+    """
+    try:
+        await log(message)
+    except Exception as err:
+        logging.info(f"Notification failed: {err}")
+
+
+async def _search_books(params: dict, ctx: Context) -> Optional[List[BookSummary]]:
+    """Unitradで検索し、中津川市立図書館の所蔵分を返す（失敗時はNone）"""
+    result = await _fetch("search", params)
+    if result is None:
+        await _notify(ctx.error, "検索に失敗しました")
+        return None
+    data, books = result
+    uuid = data.get("uuid")
+    while TARGET_LIB in (data.get('remains') or ()):
+        # サーバー側のロングポーリングで待つので、間隔は最小限にする
+        await asyncio.sleep(0.1)
+        result = await _fetch("polling", {"uuid": uuid,"timeout":"10", "version": str(data.get("version"))})
+        await _notify(ctx.info, "検索しています...")
+        if result is None:
+            await _notify(ctx.error, "検索に失敗しました")
+            return None
+        data, books = result
+
+    return books
+
+
+async def _shared_search(key: tuple, params: dict, ctx: Context) -> str:
+    """同じクエリの呼び出しで共有する検索（最初の呼び出し元のctxに進捗を通知する）"""
+    try:
+        rets_dict = await _search_books(params, ctx)
+        if rets_dict is None:
+            return orjson.dumps({
+                "books": []
+            }).decode()
+        ret = orjson.dumps({
+            "books": rets_dict
+        }).decode()
+        _cache_put(key, ret)
+        return ret
+    finally:
+        _INFLIGHT.pop(key, None)
+
+
+def _retrieve_exception(task: asyncio.Task) -> None:
+    """待機側がいない場合に未取得の例外として警告されないようにする"""
+    if not task.cancelled():
+        task.exception()
 
 
 @mcp.tool()
@@ -29,49 +215,27 @@ async def nlib_search_books(free: Optional[str],
                             year_end: Optional[int],
                             ctx: Context) -> str:
     """中津川市立図書館の蔵書を検索する"""
-    async with httpx.AsyncClient() as client:
-        response = await client.get("https://unitrad-osaka-1.calil.jp/v1/search", params={
-            "region": "gifu",
-            "free": free,
-            "title": title,
-            "author": author,
-            "publisher": publisher,
-            "ndc": ndc,
-            "year_start": year_start,
-            "year_end": year_end
-        })
-        logging.info(response.url)
-        if response.status_code != 200:
-            await ctx.error("検索に失敗しました")
-            return json.dumps({
-                "books": []
-            })
-        data = response.json()
-        uuid = data.get("uuid")
-        while "中津川市" in data['remains']:
-            response = await client.get("https://unitrad-osaka-1.calil.jp/v1/polling", params={"uuid": uuid,"timeout":"3", "version": str(data.get("version"))})
-            await ctx.info(f"検索しています...")
-            if response.status_code != 200:
-                await ctx.error("検索に失敗しました")
-                return json.dumps({
-                    "books": []
-                })
-            data = response.json()
-
-        rets = []
-        for book in data['books']:
-            if 'holdings' in book and 100914 in book['holdings']:
-                rets.append(BookSummary(
-                    id=book['id'],
-                    isbn=book['isbn'] if book['isbn'] else '',
-                    title=book['title'],
-                    author=book['author'],
-                    publisher=book['publisher'],
-                    published_year=str(book.get('pubdate')) if book.get('pubdate') else '',
-                    url=book['url'].get("100914") if book['url'].get("100914") else ''
-                ))
-
-        rets_dict = [book.model_dump() for book in rets]
-        return json.dumps({
-            "books": rets_dict
-        })
+    params = {
+        "region": "gifu",
+        "free": free,
+        "title": title,
+        "author": author,
+        "publisher": publisher,
+        "ndc": ndc,
+        "year_start": year_start,
+        "year_end": year_end
+    }
+    key = tuple(sorted((k, v) for k, v in params.items() if v is not None and v != ''))
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    task = _INFLIGHT.get(key)
+    if task is None:
+        # 検索は呼び出し元から独立したタスクで実行し、誰かのキャンセルで他の待機側を巻き込まない
+        task = asyncio.create_task(_shared_search(key, params, ctx))
+        task.add_done_callback(_retrieve_exception)
+        if not task.done():
+            _INFLIGHT[key] = task
+    # shieldしないと呼び出し側のキャンセルで共有のタスクまでキャンセルされる
+    return await asyncio.shield(task)